@@ -1,14 +1,81 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 import edge_tts
 import asyncio
-import io
+import hashlib
+import itertools
+import logging
 import os
+import queue
+import re
 import tempfile
+import threading
+import time
 from flask_cors import CORS
 
+# Unknown LOGLEVEL values fall back to WARNING instead of failing at import
+_log_level = logging.getLevelName(os.environ.get('LOGLEVEL', 'WARNING').upper())
+logging.basicConfig(level=_log_level if isinstance(_log_level, int) else logging.WARNING)
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# One long-lived event loop for all Edge TTS work, instead of a new loop per request
+_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_LOOP.run_forever, name='edge-tts-loop', daemon=True).start()
+
+# Cap on concurrent Edge TTS sessions, shared by all requests on this process's loop.
+# Values below 1 would block every request (or fail at import), so they fall back to the default.
+DEFAULT_MAX_CONCURRENT_TTS = 15
+try:
+    MAX_CONCURRENT_TTS = int(os.environ.get('MAX_CONCURRENT_TTS', DEFAULT_MAX_CONCURRENT_TTS))
+except ValueError:
+    MAX_CONCURRENT_TTS = 0
+if MAX_CONCURRENT_TTS < 1:
+    log.warning("Invalid MAX_CONCURRENT_TTS %r, using %d",
+                os.environ.get('MAX_CONCURRENT_TTS'), DEFAULT_MAX_CONCURRENT_TTS)
+    MAX_CONCURRENT_TTS = DEFAULT_MAX_CONCURRENT_TTS
+_TTS_SLOTS = asyncio.Semaphore(MAX_CONCURRENT_TTS)
+
+# Marks the end of the audio handed from the event loop to a request thread
+_END_OF_STREAM = object()
+
+# Synthesized audio is cached on disk, named by a hash of the voice and text.
+# The cache is only a speed-up, so an unusable directory disables it instead of the app.
+AUDIO_OUTPUT_DIR = os.environ.get(
+    'AUDIO_OUTPUT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audio_output')
+)
+try:
+    os.makedirs(AUDIO_OUTPUT_DIR, exist_ok=True)
+    AUDIO_CACHE_ENABLED = True
+except OSError:
+    log.warning("Cannot create %s, audio caching is disabled", AUDIO_OUTPUT_DIR, exc_info=True)
+    AUDIO_CACHE_ENABLED = False
+AUDIO_FILE_RETENTION_HOURS = float(os.environ.get('AUDIO_FILE_RETENTION_HOURS', 24))
+# /speak is public, so every unique text can add a file; the size cap keeps that
+# from filling the disk within the retention period (enforced on each sweep)
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_MB', 1024)) * 1024 * 1024
+AUDIO_CLEANUP_INTERVAL_SECONDS = 600
+# The janitor only touches files the cache creates: <sha256>.mp3 and mkstemp's tmp*.part
+_CACHE_FILE_NAME = re.compile(r'[0-9a-f]{64}\.mp3|tmp[a-z0-9_]+\.part')
+# Audio for a given voice and text never changes, so clients may keep it for a day
+AUDIO_CACHE_MAX_AGE = 86400
+
+DEFAULT_VOICE = "en-US-AriaNeural"
+
+# Listing voices would require an async call to Edge TTS,
+# so a fixed set of common voices is served instead
+COMMON_VOICES = (
+    "en-US-AriaNeural",
+    "en-US-JennyNeural",
+    "en-US-GuyNeural",
+    "en-GB-SoniaNeural",
+    "en-GB-RyanNeural",
+    "en-AU-NatashaNeural",
+    "en-AU-WilliamNeural",
+)
+
 @app.route('/')
 def home():
     return jsonify({
@@ -24,9 +91,9 @@ def home():
 def process_text():
     """Original endpoint that returns 'good' as text"""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
         
-        if not data or 'text' not in data:
+        if not isinstance(data, dict) or 'text' not in data:
             return jsonify({"error": "Please provide 'text' in JSON body"}), 400
         
         text = data['text']
@@ -40,19 +107,23 @@ def process_text():
         return jsonify(response)
     
     except Exception as e:
+        log.exception("Text processing failed")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/speak', methods=['POST'])
 def text_to_speech():
     """New endpoint that converts text to speech using Edge TTS"""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
         
-        if not data or 'text' not in data:
+        if not isinstance(data, dict) or 'text' not in data:
             return jsonify({"error": "Please provide 'text' in JSON body"}), 400
         
         text = data['text']
         
+        if not isinstance(text, str):
+            return jsonify({"error": "'text' must be a string"}), 400
+        
         # Validate text length
         if len(text.strip()) == 0:
             return jsonify({"error": "Text cannot be empty"}), 400
@@ -60,63 +131,192 @@ def text_to_speech():
         if len(text) > 3000:
             return jsonify({"error": "Text too long. Maximum 3000 characters."}), 400
         
-        # Run the async function
-        audio_data = asyncio.run(generate_speech(text))
+        # Serve repeated requests straight from the cache. The janitor may expire
+        # the file at any moment, so a missing file just falls through to synthesis.
+        cache_key = hashlib.sha256(f"{DEFAULT_VOICE}|{text}".encode()).hexdigest()
+        cache_path = os.path.join(AUDIO_OUTPUT_DIR, f"{cache_key}.mp3")
+        if AUDIO_CACHE_ENABLED:
+            try:
+                response = send_file(
+                    cache_path,
+                    as_attachment=True,
+                    download_name='speech.mp3',
+                    mimetype='audio/mpeg',
+                    etag=False,
+                    max_age=AUDIO_CACHE_MAX_AGE
+                )
+                # The key hashes the request, not the MP3 bytes, so the ETag is weak
+                response.set_etag(cache_key, weak=True)
+                log.debug("Serving cached audio %s", cache_key)
+                return response
+            except FileNotFoundError:
+                pass
+        
+        # Stream audio from the shared event loop as Edge TTS produces it.
+        # Wait for the first chunk so errors before any audio still get a JSON response;
+        # later errors can only end the already started stream early.
+        audio_stream = stream_speech(text)
+        first_chunk = next(audio_stream)
         
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as tmp_file:
-            tmp_file.write(audio_data)
-            temp_filename = tmp_file.name
+        audio_stream = itertools.chain([first_chunk], audio_stream)
+        if AUDIO_CACHE_ENABLED:
+            audio_stream = save_to_cache(audio_stream, cache_path)
         
-        # Return the audio file
-        return send_file(
-            temp_filename,
-            as_attachment=True,
-            download_name='speech.mp3',
-            mimetype='audio/mpeg'
+        response = Response(
+            end_stream_on_error(audio_stream),
+            mimetype='audio/mpeg',
+            headers={'Content-Disposition': 'attachment; filename=speech.mp3'}
         )
+        # Same weak ETag as a cache hit. Freshness headers are left to cache hits,
+        # since this stream can still end early if synthesis fails.
+        response.set_etag(cache_key, weak=True)
+        return response
     
     except Exception as e:
+        log.exception("Speech synthesis failed")
         return jsonify({"error": str(e)}), 500
 
-async def generate_speech(text, voice="en-US-AriaNeural"):
+async def generate_speech(text, voice=DEFAULT_VOICE):
     """
-    Generate speech using Edge TTS
+    Generate speech using Edge TTS, yielding MP3 data as it arrives
     Available voices: en-US-AriaNeural, en-US-JennyNeural, en-GB-SoniaNeural, etc.
     """
     try:
         communicate = edge_tts.Communicate(text, voice)
         
-        # Collect audio data
-        audio_chunks = []
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_chunks.append(chunk["data"])
-        
-        # Combine all audio chunks
-        return b''.join(audio_chunks)
+        async with _TTS_SLOTS:
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    yield chunk["data"]
         
     except Exception as e:
         raise Exception(f"Edge TTS error: {str(e)}")
 
+def stream_speech(text, voice=DEFAULT_VOICE):
+    """Run generate_speech on the shared event loop and yield its audio in the calling thread"""
+    chunks = queue.Queue()
+    
+    async def pump():
+        try:
+            async for data in generate_speech(text, voice):
+                chunks.put(data)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(_END_OF_STREAM)
+    
+    future = asyncio.run_coroutine_threadsafe(pump(), _LOOP)
+    try:
+        while True:
+            item = chunks.get()
+            if item is _END_OF_STREAM:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop synthesis if the client went away before the stream finished
+        future.cancel()
+
+def end_stream_on_error(audio_stream):
+    """Stop a response whose headers are already sent when synthesis fails part way through"""
+    try:
+        yield from audio_stream
+    except Exception:
+        log.exception("Speech synthesis failed")
+
+def save_to_cache(audio_stream, cache_path):
+    """
+    Pass audio through while writing it to the cache, publishing the file only once complete.
+    Caching is best effort: after any file error the rest of the audio streams uncached.
+    """
+    cache_file = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=AUDIO_OUTPUT_DIR, suffix='.part')
+        cache_file = os.fdopen(fd, 'wb')
+    except OSError:
+        log.warning("Could not create a cache file in %s", AUDIO_OUTPUT_DIR, exc_info=True)
+    
+    try:
+        for data in audio_stream:
+            if cache_file is not None:
+                try:
+                    cache_file.write(data)
+                except OSError:
+                    log.warning("Could not write %s, streaming uncached", temp_path, exc_info=True)
+                    discard_cache_file(cache_file, temp_path)
+                    cache_file = None
+            yield data
+        
+        if cache_file is not None:
+            try:
+                cache_file.close()
+                os.replace(temp_path, cache_path)
+            except OSError:
+                log.warning("Could not publish %s", cache_path, exc_info=True)
+                discard_cache_file(cache_file, temp_path)
+            cache_file = None
+    finally:
+        # The stream failed or the client went away before the audio was complete
+        if cache_file is not None:
+            discard_cache_file(cache_file, temp_path)
+
+def discard_cache_file(cache_file, temp_path):
+    """Close and remove a partly written cache file, ignoring further file errors"""
+    try:
+        cache_file.close()
+    except OSError:
+        pass
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+
+def remove_expired_audio():
+    """Periodically sweep the audio cache"""
+    while True:
+        try:
+            sweep_audio_cache()
+        except OSError:
+            log.warning("Could not clean up %s, retrying on the next sweep", AUDIO_OUTPUT_DIR, exc_info=True)
+        time.sleep(AUDIO_CLEANUP_INTERVAL_SECONDS)
+
+def sweep_audio_cache():
+    """Delete cache files past the retention period, then the oldest ones while over the size cap"""
+    cutoff = time.time() - AUDIO_FILE_RETENTION_HOURS * 3600
+    kept = []
+    with os.scandir(AUDIO_OUTPUT_DIR) as entries:
+        for entry in entries:
+            if not _CACHE_FILE_NAME.fullmatch(entry.name):
+                continue
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat()
+                if stat.st_mtime < cutoff:
+                    os.unlink(entry.path)
+                else:
+                    kept.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                pass  # Already removed by a concurrent request or sweep
+    
+    total_size = sum(size for _, size, _ in kept)
+    for _, size, path in sorted(kept):
+        if total_size <= AUDIO_CACHE_MAX_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total_size -= size
+
+if AUDIO_CACHE_ENABLED:
+    threading.Thread(target=remove_expired_audio, name='audio-janitor', daemon=True).start()
+
 @app.route('/voices', methods=['GET'])
 def get_voices():
     """Get available Edge TTS voices"""
-    try:
-        # This would typically require an async function
-        # For simplicity, returning some common voices
-        common_voices = [
-            "en-US-AriaNeural",
-            "en-US-JennyNeural", 
-            "en-US-GuyNeural",
-            "en-GB-SoniaNeural",
-            "en-GB-RyanNeural",
-            "en-AU-NatashaNeural",
-            "en-AU-WilliamNeural"
-        ]
-        return jsonify({"voices": common_voices})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return jsonify({"voices": COMMON_VOICES})
 
 @app.route('/health', methods=['GET'])
 def health_check():